@@ -1,147 +1,443 @@
-# import os
+import os
 # import sys
+import asyncio
+import concurrent.futures
 import subprocess
+import hashlib
+import sqlite3
+import queue
+import threading
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import shutil
 
 LOG_FILE = "./failures.log"
+MANIFEST_FILE = "./.pdfcompress_manifest.db"
+MANIFEST_BATCH = 100 # Manifest rows written per commit
+GHOSTSCRIPT = 'gswin64c' if os.name == 'nt' else 'gs'
+OCR_JOBS = 2 # Threads each ocrmypdf run may use; worker count is sized around it
+PROGRESS_INTERVAL = 1.0 # Seconds between progress lines
+FINGERPRINT_BYTES = 1024 * 1024 # Leading bytes hashed to spot duplicate inputs cheaply
+TEXT_PROBE_PAGES = 3 # Leading pages checked for an existing text layer
 
-def compress_pdf(input_path, output_path, target_size_mb=1.4, max_quality=40, min_quality=3):
+_log_queue = None # Set while find_and_compress_pdfs runs; failure-log lines go to its writer thread
+_quality_hints = {} # folder -> last quality that met the target
+
+def log_failure(line):
+    """
+    Queue a line for the failure log, or append it directly when no writer thread is running.
+    """
+    if _log_queue is not None:
+        _log_queue.put(line)
+    else:
+        with open(LOG_FILE, 'a') as log:
+            log.write(line)
+
+def write_log_batches(log_queue):
+    """
+    Append queued failure-log lines to LOG_FILE, one open/write per batch, until a None sentinel arrives.
+    """
+    while True:
+        records = [log_queue.get()]
+        while True:
+            try:
+                records.append(log_queue.get_nowait())
+            except queue.Empty:
+                break
+        lines = [record for record in records if record is not None]
+        if lines:
+            with open(LOG_FILE, 'a') as log:
+                log.writelines(lines)
+        if None in records:
+            return
+
+async def run_command(cmd, capture_stdout=False):
+    """
+    Run cmd without blocking the event loop, returning its stdout if capture_stdout, else discarding it.
+    Raises subprocess.CalledProcessError carrying its stderr if it exits non-zero.
+    """
+    stdout_target = asyncio.subprocess.PIPE if capture_stdout else asyncio.subprocess.DEVNULL
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdout=stdout_target, stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await proc.communicate()
+    except asyncio.CancelledError:
+        # Don't leave the command running behind a cancelled task
+        if proc.returncode is None:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+        await proc.wait()
+        raise
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=stderr)
+    return stdout
+
+async def has_text_layer(input_path):
+    """
+    Whether the first TEXT_PROBE_PAGES pages of input_path already carry text of their own.
+    Asks Ghostscript, which the Ghostscript pass needs anyway, to extract their text; if gs is missing or
+    can't read the file, the answer is False so OCR output is never given up on a guess.
+    """
+    cmd = [
+        GHOSTSCRIPT,
+        '-sDEVICE=txtwrite',
+        '-dFirstPage=1', f'-dLastPage={TEXT_PROBE_PAGES}',
+        '-dNOPAUSE', '-dQUIET', '-dBATCH',
+        '-sOutputFile=-',
+        str(input_path)
+    ]
+    try:
+        text = await run_command(cmd, capture_stdout=True)
+    except (FileNotFoundError, subprocess.CalledProcessError):
+        return False
+    return bool(text.strip())
+
+async def start_ghostscript(input_path, gs_output):
+    """
+    Start a Ghostscript-only recompression of input_path into gs_output, or return None if gs is missing.
+    """
+    cmd = [
+        GHOSTSCRIPT,
+        '-sDEVICE=pdfwrite',
+        '-dPDFSETTINGS=/ebook',
+        '-dNOPAUSE', '-dQUIET', '-dBATCH',
+        f'-sOutputFile={gs_output}',
+        str(input_path)
+    ]
+    try:
+        return await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL
+        )
+    except FileNotFoundError:
+        return None
+
+async def finish_ghostscript(gs_proc, gs_output, cancel=False):
+    """
+    Wait for a run started by start_ghostscript and return the size of gs_output, or None if it failed
+    or was cancelled.
+    """
+    if cancel and gs_proc.returncode is None:
+        try:
+            gs_proc.kill()
+        except ProcessLookupError:
+            pass # Exited between the check and the kill
+    if await gs_proc.wait() != 0 or cancel:
+        gs_output.unlink(missing_ok=True)
+        return None
+    return gs_output.stat().st_size
+
+def predict_quality(samples, target_size):
+    """
+    Fit size = a * quality + b to the (quality, size) samples by least squares and solve for target_size.
+    Returns None until there are two distinct qualities, or if the fitted slope isn't positive.
+    """
+    n = len(samples)
+    if n < 2:
+        return None
+    mean_quality = sum(quality for quality, _ in samples) / n
+    mean_size = sum(size for _, size in samples) / n
+    spread = sum((quality - mean_quality) ** 2 for quality, _ in samples)
+    if spread == 0:
+        return None
+    slope = sum((quality - mean_quality) * (size - mean_size) for quality, size in samples) / spread
+    if slope <= 0:
+        return None
+    return int((target_size - (mean_size - slope * mean_quality)) / slope)
+
+async def compress_pdf(input_path, output_path, target_size_mb=1.4, max_quality=40, min_quality=3, quality_step=5, input_size=None):
     """
     Compress a PDF file to approximately target_size_mb using ocrmypdf with quality adjustments.
+
+    Output size grows with JPEG quality, so the highest quality that fits the target is found by
+    searching [min_quality, max_quality] until the bracket is narrower than quality_step; once two sizes
+    are known the next quality is extrapolated from them while that narrows the bracket quickly, otherwise
+    the bracket is bisected. Inputs already under the target are copied as-is. input_size may be passed
+    in to avoid re-stat'ing the input.
+    Files in the same folder tend to compress alike, so the quality that last met the target there is
+    tried first. For inputs that already have a text layer, a Ghostscript-only pass runs alongside the
+    first attempt and is kept instead if it meets the target with a smaller file; image-only scans skip it,
+    since only ocrmypdf's output would be searchable.
     """
     temp_output = output_path.with_suffix('.temp.pdf')
+    best_path = output_path.with_suffix('.best.pdf') # Smallest oversized attempt, kept for best effort
+    gs_output = output_path.with_suffix('.gs.pdf')
+    target_size = target_size_mb * 1024 * 1024
 
     best_quality_so_far = -1 # Initialize with a value that ensures first quality is better
     min_size_so_far = float('inf') # Initialize with infinity
     final_success = False # Tracks if target size was achieved
-    current_quality = max_quality
+    fit_quality = -1 # Highest quality that met the target
+    samples = [] # (quality, size) of every completed attempt
+    stalled = False # The last extrapolated probe moved the same bound as the probe before it
+    last_fit = None # Whether the previous probe met the target
 
-    # quality = max_quality
-    # success = False
-    # best_attempt = None
-    # best_temp_path = None # Stores the path to the best temporary file found so far
-    
-    while current_quality >= min_quality:
+    # Already small enough - no need to run ocrmypdf at all
+    if input_size is None:
+        input_size = input_path.stat().st_size
+    size_ratio = input_size / target_size
+    if size_ratio <= 1.0:
+        shutil.copy2(input_path, output_path)
+        return True
+
+    folder = str(input_path.parent)
+    hinted_quality = _quality_hints.get(folder)
+    lo, hi = min_quality, max_quality
+    # If the folder's last fit fits again, one step above it is tried next so the hint can rise
+    check_above_hint = hinted_quality is not None
+    if hinted_quality is not None:
+        next_quality = hinted_quality
+    else:
+        # Seed the first probe from how oversized the input is, erring on the side of more compression;
+        # the bracket still spans every quality, so a seed that misses either way can be recovered from
+        next_quality = int(max_quality / size_ratio ** 0.5) - 5
+
+    # Built once per file; only the quality slot changes between attempts
+    cmd = [
+        'ocrmypdf',
+        '--optimize', '3',
+        '--jobs', str(OCR_JOBS),
+        '--skip-text',  # Skip OCR on pages that already have a text layer
+        # '--force-ocr',  # Force OCR if needed (adjust based on your needs)
+        # '--deskew',     # Deskew images
+        # '--clean',     # Clean images
+        # '--jbig2-lossy',  # Use lossy JBIG2 compression
+        '--jpeg-quality', '',
+        os.fspath(input_path),
+        os.fspath(temp_output)
+    ]
+    quality_slot = cmd.index('--jpeg-quality') + 1
+
+    # Ghostscript adds no OCR, so it only competes when the input is searchable already. It runs beside
+    # ocrmypdf in the same worker slot; with --skip-text those inputs leave ocrmypdf little OCR to do
+    gs_proc = None
+    if await has_text_layer(input_path):
+        gs_proc = await start_ghostscript(input_path, gs_output)
+
+    while lo <= hi:
+        extrapolated = False
+        if next_quality is not None:
+            current_quality = max(lo, min(next_quality, hi))
+            next_quality = None
+        # Once the bracket is narrower than one step, only the lowest quality is worth a last try
+        elif hi - lo < quality_step:
+            current_quality = lo
+        else:
+            # Extrapolate only while it keeps cutting the bracket by at least a quarter and isn't
+            # stuck on one side (a straight-line fit keeps overshooting on convex size curves);
+            # otherwise bisect
+            margin = (hi - lo) // 4
+            predicted_quality = None if stalled else predict_quality(samples, target_size)
+            if predicted_quality is not None and lo + margin <= predicted_quality <= hi - margin:
+                current_quality = predicted_quality
+                extrapolated = True
+            else:
+                current_quality = (lo + hi + 1) // 2
         try:
             # Run ocrmypdf with current quality setting
-            cmd = [
-                'ocrmypdf',
-                # '--optimize', str(quality),
-                '--optimize', '3',
-                # '--skip-text',  # Skip OCR to save time if text already exists
-                # '--force-ocr',  # Force OCR if needed (adjust based on your needs)
-                # '--deskew',     # Deskew images
-                # '--clean',     # Clean images
-                # '--jbig2-lossy',  # Use lossy JBIG2 compression
-                '--jpeg-quality', str(current_quality),
-                str(input_path),
-                str(temp_output)
-            ]
-            
-            subprocess.run(cmd, check=True, capture_output=True)
+            cmd[quality_slot] = str(current_quality)
+            await run_command(cmd)
             current_size = temp_output.stat().st_size
+            samples.append((current_quality, current_size))
             
-            if current_size <= target_size_mb * 1024 * 1024:
-                shutil.move(temp_output, output_path)
-                success = True
-                break
+            if current_size <= target_size:
+                # Every fit is at a higher quality than the previous one, so it replaces it
+                os.replace(temp_output, output_path)
+                final_success = True
+                fit_quality = current_quality
+                lo = current_quality + 1
+                if check_above_hint:
+                    next_quality = current_quality + quality_step
             else:
-                # if best_temp_path is None or current_size < best_temp_path.stat().st_size:
-                #     if best_temp_path is not None:
-                #         best_temp_path.unlink(missing_ok=True) 
-                #     best_temp_path = temp_output.with_suffix('.best.pdf')
-                #     shutil.move(temp_output, best_temp_path)
-                # quality -= 5
-                
                 if current_size < min_size_so_far:
                     min_size_so_far = current_size
                     best_quality_so_far = current_quality
+                    os.replace(temp_output, best_path)
                 if temp_output.exists():
                     temp_output.unlink(missing_ok=True)
-                current_quality -= 5
+                hi = current_quality - 1
                 
         except subprocess.CalledProcessError as e:
             print(f"Error processing {input_path} with quality {current_quality}: {e.stderr.decode()}")
-            # temp_output.unlink(missing_ok=True)
-            # quality -= 5
-            # continue
             if temp_output.exists():
                     temp_output.unlink(missing_ok=True)
-            current_quality -= 5
-            continue
+            hi = current_quality - 1
+        except asyncio.CancelledError:
+            temp_output.unlink(missing_ok=True)
+            best_path.unlink(missing_ok=True)
+            if gs_proc is not None:
+                await finish_ghostscript(gs_proc, gs_output, cancel=True)
+            raise
         except FileNotFoundError:
             print(f"Error: ocrmypdf or tesseract not found. Please ensure they are installed and in your PATH.")
+            if gs_proc is not None:
+                await finish_ghostscript(gs_proc, gs_output, cancel=True)
             return False
         except Exception as e:
             print(f"An unexpected error occurred: {e}")
+            if gs_proc is not None:
+                await finish_ghostscript(gs_proc, gs_output, cancel=True)
             return False
-    
-    # if not success:
-    #     if best_temp_path is not None:
-    #         shutil.move(best_temp_path, output_path)
-    #         with open(LOG_FILE, 'a') as log:
-    #             log.write(f"{input_path} - Compressed to {output_path.stat().st_size/1024/1024:.2f} MB (target: {target_size_mb} MB)\n")
-    #         return True
-    #     else:
-    #         print(f"Error: Could not compress {input_path} at any quality level")
-    #         return False
-    
-    # if temp_output.exists():
-    #     temp_output.unlink(missing_ok=True)
-    
-    # return success
-    
-    if not final_success and best_quality_so_far != -1:
-        try:
-            print(f"Target size not met. Generating best possible output with quality {best_quality_so_far}.")
-            cmd = [
-                'ocrmypdf',
-                '--optimize', '3',
-                '--jpeg-quality', str(best_quality_so_far),
-                str(input_path),
-                str(output_path) # Write directly to final output path
-            ]
-            subprocess.run(cmd, check=True, capture_output=True)
 
-            with open(LOG_FILE, 'a') as log:
-                log.write(f"{input_path} - Compressed to {output_path.stat().st_size/1024/1024:.2f} MB (target: {target_size_mb} MB) (Best Effort)\n")
-            return True # Indicate success for best effort
-        except subprocess.CalledProcessError as e:
-            print(f"Error generating best effort output for {input_path}: {e.stderr.decode()}")
-            return False
-        except Exception as e:
-            print(f"An unexpected error occurred during best effort generation: {e}")
-            return False
-    elif not final_success and best_quality_so_far == -1:
+        check_above_hint = False
+        current_fit = lo > current_quality # A fit raised lo past the probe; a miss or error lowered hi
+        stalled = extrapolated and current_fit == last_fit
+        last_fit = current_fit
+
+        if gs_proc is not None:
+            # The Ghostscript pass ran alongside this first attempt; keep it if it fits and is smaller,
+            # otherwise drop it and carry on searching for the best ocrmypdf quality
+            try:
+                gs_size = await finish_ghostscript(gs_proc, gs_output)
+            except asyncio.CancelledError:
+                best_path.unlink(missing_ok=True)
+                await finish_ghostscript(gs_proc, gs_output, cancel=True)
+                raise
+            gs_proc = None
+            if gs_size is not None and gs_size <= target_size and (
+                not final_success or gs_size < output_path.stat().st_size
+            ):
+                os.replace(gs_output, output_path)
+                final_success = True
+                fit_quality = -1 # The search stopped at its first probe, so it shouldn't seed the folder
+                break
+            gs_output.unlink(missing_ok=True)
+
+        if final_success and hi - lo < quality_step:
+            break
+    
+    if final_success:
+        best_path.unlink(missing_ok=True)
+        if fit_quality != -1:
+            _quality_hints[folder] = fit_quality
+    elif best_quality_so_far != -1:
+        os.replace(best_path, output_path)
+        print(f"Target size not met. Kept best possible output with quality {best_quality_so_far}.")
+        log_failure(f"{input_path} - Compressed to {min_size_so_far/1024/1024:.2f} MB (target: {target_size_mb} MB) (Best Effort)\n")
+        return True # Indicate success for best effort
+    else:
         print(f"Error: Could not compress {input_path} at any quality level.")
         return False
 
     return final_success 
 
 
-def process_pdf(input_path, output_path):
+async def process_pdf(input_path, output_path, input_stat=None):
     """
     Process a single PDF file, creating parent directories if needed.
+    input_stat is the os.stat_result already gathered while walking the source tree, if any.
     """
     try:
+        # Reject empty files and non-PDFs before paying for an ocrmypdf start-up
+        input_size = input_stat.st_size if input_stat is not None else input_path.stat().st_size
+        if input_size == 0:
+            print(f"Skipping {input_path} - file is empty")
+            return False
+        with open(input_path, 'rb') as f:
+            if f.read(5) != b'%PDF-':
+                print(f"Skipping {input_path} - not a PDF file")
+                return False
+        
         output_path.parent.mkdir(parents=True, exist_ok=True)
         if output_path.exists():
             print(f"Skipping {input_path} - output already exists")
             return True
         
         print(f"Processing {input_path} -> {output_path}")
-        return compress_pdf(input_path, output_path)
+        return await compress_pdf(input_path, output_path, input_size=input_size)
     
     except Exception as e:
         print(f"Error processing {input_path}: {str(e)}")
         return False
 
-def find_and_compress_pdfs(source_dir, dest_dir, max_workers=4):
+def iter_pdf_entries(directory):
+    """
+    Recursively yield os.DirEntry objects for the PDF files under directory.
+    DirEntry caches the stat data returned by the directory listing, so callers can use entry.stat()
+    without an extra syscall per file on Windows. Directories that can't be read are skipped.
+    """
+    try:
+        entries = os.scandir(directory)
+    except OSError as e:
+        print(f"Skipping directory {directory}: {str(e)}")
+        return
+    with entries:
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                is_pdf = not is_dir and entry.name.lower().endswith('.pdf') and entry.is_file()
+            except OSError as e:
+                print(f"Skipping {entry.path}: {str(e)}")
+                continue
+            if is_dir:
+                yield from iter_pdf_entries(entry.path)
+            elif is_pdf:
+                yield entry
+
+def pdf_fingerprint(path, size):
+    """
+    Cheap content fingerprint: the file size plus a blake2b digest of its first FINGERPRINT_BYTES.
+    """
+    with open(path, 'rb') as f:
+        return size, hashlib.blake2b(f.read(FINGERPRINT_BYTES)).hexdigest()
+
+def file_digest(path):
+    """
+    Full blake2b digest of a file, used to confirm a fingerprint match.
+    """
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'blake2b').hexdigest()
+
+def reuse_output(existing_output, output_path):
+    """
+    Hard-link an already-compressed output to output_path, copying where links aren't supported.
+    """
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(existing_output, output_path)
+    except OSError:
+        shutil.copy2(existing_output, output_path)
+
+def open_manifest(manifest_file=MANIFEST_FILE):
+    """
+    Open the processed-files manifest, creating its table on first use.
+    Rows are keyed by input and output path, so compressing the same source into another dest_dir
+    starts afresh. A table from before outputs were recorded is dropped rather than trusted.
+    """
+    conn = sqlite3.connect(manifest_file)
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(manifest)")]
+    if columns and 'output_path' not in columns:
+        conn.execute("DROP TABLE manifest")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS manifest "
+        "(input_path TEXT, output_path TEXT, input_mtime REAL, input_size INT, status TEXT, "
+        "PRIMARY KEY (input_path, output_path))"
+    )
+    return conn
+
+def load_manifest(conn):
+    """
+    Return {(input_path, output_path): (input_mtime, input_size)} for every input recorded as
+    compressed successfully.
+    """
+    rows = conn.execute(
+        "SELECT input_path, output_path, input_mtime, input_size FROM manifest WHERE status = 'ok'"
+    )
+    return {
+        (input_path, output_path): (input_mtime, input_size)
+        for input_path, output_path, input_mtime, input_size in rows
+    }
+
+def find_and_compress_pdfs(source_dir, dest_dir, max_workers=None):
     """
     Find all PDFs in source_dir and compress them to dest_dir maintaining structure.
+    Files are compressed concurrently from a single asyncio event loop, at most max_workers at a time.
+    By default that is one file per OCR_JOBS CPU cores, since each ocrmypdf run is itself parallel.
     """
+    global _log_queue
+    if max_workers is None:
+        max_workers = max(1, (os.cpu_count() or 4) // OCR_JOBS)
     source_path = Path(source_dir)
     dest_path = Path(dest_dir)
     
@@ -149,48 +445,226 @@ def find_and_compress_pdfs(source_dir, dest_dir, max_workers=4):
         print(f"Error: Source directory {source_dir} does not exist")
         return
     
-    pdf_files = list(source_path.glob('**/*.pdf'))
-    total_files = len(pdf_files)
-    print(f"Found {total_files} PDF files to process")
-    
     # Parallel processing
+    total_files = 0
     processed_count = 0
     failed_count = 0
     skipped_count = 0
+    duplicate_count = 0
+    max_pending = 4 * max_workers # Bound on submitted-but-unfinished files, so memory doesn't grow with the tree
+    seen = {} # fingerprint -> [input, output, full digest or None]
+
+    # Inputs unchanged since a successful run to the same output are skipped without looking at the output tree
+    manifest = open_manifest()
+    completed = load_manifest(manifest)
+    manifest_rows = []
+
+    def record(manifest_key, input_stat, ok):
+        manifest_rows.append((*manifest_key, input_stat.st_mtime, input_stat.st_size, 'ok' if ok else 'failed'))
+        if len(manifest_rows) >= MANIFEST_BATCH:
+            flush_manifest()
+
+    def flush_manifest():
+        manifest.executemany("INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?, ?)", manifest_rows)
+        manifest.commit()
+        manifest_rows.clear()
+
+    def collect(task, manifest_key, input_stat):
+        nonlocal processed_count, failed_count
+        try:
+            result = task.result()
+            if result:
+                processed_count += 1
+            else:
+                failed_count += 1
+            record(manifest_key, input_stat, result)
+        except Exception as e:
+            print(f"Error in task: {str(e)}")
+            failed_count += 1
+    
+    async def reuse_for_duplicates(existing_output, duplicates):
+        nonlocal duplicate_count, failed_count
+        for output_file, manifest_key, input_stat in duplicates:
+            try:
+                await asyncio.to_thread(reuse_output, existing_output, output_file)
+                duplicate_count += 1
+                record(manifest_key, input_stat, True)
+            except OSError as e:
+                print(f"Error reusing {existing_output} for {output_file}: {str(e)}")
+                failed_count += 1
+                record(manifest_key, input_stat, False)
     
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = []
+    async def compress_limited(semaphore, input_file, output_file, input_stat):
+        async with semaphore:
+            return await process_pdf(input_file, output_file, input_stat)
+
+    async def report_progress():
+        # Progress is reported on a timer rather than per finished file
+        last_reported = 0
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            finished = processed_count + failed_count
+            if finished != last_reported:
+                print(f"Progress: {finished} processed, {total_files} found")
+                last_reported = finished
+
+    def scan(loop, found, stop):
+        """
+        Walk source_path in a worker thread, doing the stat, skip and duplicate checks there.
+        Each input to compress is handed to the event loop through found; None marks the end of the walk.
+        Inputs that could not be read are handed over with no output path, to be counted as failed, and
+        duplicates with the output of the identical input they should reuse.
+        """
+        nonlocal total_files, skipped_count
         
-        for input_file in pdf_files:
-            # Calculate corresponding output path
-            relative_path = input_file.relative_to(source_path)
-            output_file = dest_path / relative_path
-            
-            # Skip if output exists and is newer than input
-            if output_file.exists() and output_file.stat().st_mtime >= input_file.stat().st_mtime:
-                skipped_count += 1
-                continue
+        def hand_over(item):
+            # Block while the loop is behind, but give up once dispatch has stopped listening
+            future = asyncio.run_coroutine_threadsafe(found.put(item), loop)
+            while True:
+                try:
+                    future.result(timeout=0.1)
+                    return True
+                except concurrent.futures.TimeoutError:
+                    if stop.is_set():
+                        future.cancel()
+                        return False
+        
+        try:
+            for entry in iter_pdf_entries(source_path):
+                if stop.is_set():
+                    return
+                total_files += 1
+                # Calculate corresponding output path
+                input_file = Path(entry.path)
+                output_file = dest_path / os.path.relpath(entry.path, source_path)
+                try:
+                    input_stat = entry.stat()
+                except OSError as e:
+                    print(f"Error processing {input_file}: {str(e)}")
+                    if not hand_over((input_file, None, None, None, None)):
+                        return
+                    continue
+                manifest_key = (os.path.abspath(entry.path), os.path.abspath(output_file))
+                
+                if completed.get(manifest_key) == (input_stat.st_mtime, input_stat.st_size):
+                    skipped_count += 1
+                    continue
                 
-            futures.append(executor.submit(process_pdf, input_file, output_file))
+                # Skip if output exists and is newer than input
+                try:
+                    if os.stat(output_file).st_mtime >= input_stat.st_mtime:
+                        skipped_count += 1
+                        continue
+                except OSError:
+                    pass # No usable output yet; process_pdf reports it if it can't be written either
+                
+                # Identical inputs are compressed once; the rest reuse that output once it exists
+                try:
+                    fingerprint = pdf_fingerprint(input_file, input_stat.st_size)
+                    original = seen.get(fingerprint)
+                    if original is None:
+                        seen[fingerprint] = [input_file, output_file, None]
+                        is_duplicate = False
+                    else:
+                        # Files no larger than the fingerprint window were hashed in full already
+                        is_duplicate = input_stat.st_size <= FINGERPRINT_BYTES
+                        if not is_duplicate:
+                            if original[2] is None:
+                                original[2] = file_digest(original[0])
+                            is_duplicate = file_digest(input_file) == original[2]
+                except OSError as e:
+                    # Locked or deleted since the walk found it
+                    print(f"Error processing {input_file}: {str(e)}")
+                    if not hand_over((input_file, None, manifest_key, input_stat, None)):
+                        return
+                    continue
+                existing_output = original[1] if is_duplicate else None
+                if not hand_over((input_file, output_file, manifest_key, input_stat, existing_output)):
+                    return
+        finally:
+            if not stop.is_set():
+                hand_over(None)
+    
+    async def dispatch():
+        nonlocal failed_count
+        reporter = asyncio.create_task(report_progress())
+        # ocrmypdf does the heavy lifting in child processes; the semaphore caps how many files run at once
+        semaphore = asyncio.Semaphore(max_workers)
+        pending = {} # task -> (output, manifest key, input stat)
+        # Duplicates are resolved as soon as their original finishes, so this only holds in-flight outputs
+        waiting = {} # output of an unfinished original -> [(output to create, manifest key, input stat)]
+        # The walk and hashing run in a thread so a long run of skipped inputs can't stall the loop
+        found = asyncio.Queue(maxsize=max_pending)
         
-        for future in as_completed(futures):
-            try:
-                result = future.result()
-                if result:
-                    processed_count += 1
-                else:
+        async def finish(done):
+            for task in done:
+                output_file, manifest_key, input_stat = pending.pop(task)
+                collect(task, manifest_key, input_stat)
+                await reuse_for_duplicates(output_file, waiting.pop(output_file))
+        
+        stop = threading.Event()
+        scanner = asyncio.create_task(asyncio.to_thread(scan, asyncio.get_running_loop(), found, stop))
+        
+        try:
+            # Files are submitted as the walk finds them, so compression starts before the walk ends
+            while True:
+                item = await found.get()
+                if item is None:
+                    break
+                input_file, output_file, manifest_key, input_stat, existing_output = item
+                if output_file is None:
                     failed_count += 1
+                    if input_stat is not None:
+                        record(manifest_key, input_stat, False)
+                    continue
+                if existing_output is not None:
+                    if existing_output in waiting:
+                        waiting[existing_output].append((output_file, manifest_key, input_stat))
+                    else:
+                        await reuse_for_duplicates(existing_output, [(output_file, manifest_key, input_stat)])
+                    continue
                 
-                if (processed_count + failed_count) % 100 == 0:
-                    print(f"Progress: {processed_count + failed_count}/{total_files} processed")
-                    
-            except Exception as e:
-                print(f"Error in future: {str(e)}")
-                failed_count += 1
+                if len(pending) >= max_pending:
+                    done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    await finish(done)
+                
+                task = asyncio.create_task(compress_limited(semaphore, input_file, output_file, input_stat))
+                pending[task] = (output_file, manifest_key, input_stat)
+                waiting[output_file] = []
+            await scanner
+        
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                await finish(done)
+        finally:
+            reporter.cancel()
+            # Let the walk thread finish its current entry and exit, or asyncio.run would wait on it
+            stop.set()
+            # On an error or Ctrl-C, unwind in-flight files here so their subprocesses are torn down
+            # cleanly before asyncio.run cancels everything else
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(scanner, *pending, return_exceptions=True)
+    
+    # A single writer thread owns the failure log; compress_pdf only enqueues lines
+    _log_queue = queue.Queue()
+    log_writer = threading.Thread(target=write_log_batches, args=(_log_queue,), daemon=True)
+    log_writer.start()
+    
+    try:
+        asyncio.run(dispatch())
+    finally:
+        # Keep what finished even if the run is interrupted
+        flush_manifest()
+        manifest.close()
+        _log_queue.put(None)
+        log_writer.join()
+        _log_queue = None
     
     print(f"\nProcessing complete:")
     print(f"- Total files: {total_files}")
     print(f"- Processed successfully: {processed_count}")
+    print(f"- Reused for duplicate inputs: {duplicate_count}")
     print(f"- Failed: {failed_count}")
     print(f"- Skipped (already exists): {skipped_count}")
 
@@ -199,5 +673,5 @@ if __name__ == "__main__":
     dest_dir = "J:\\OBSCD\\Python compression test results"
     
     print(f"Starting PDF compression from {source_dir} to {dest_dir}")
-    find_and_compress_pdfs(source_dir, dest_dir, max_workers=8)  # Adjust max_workers based on your CPU cores
+    find_and_compress_pdfs(source_dir, dest_dir)  # Worker count is derived from the CPU core count
 